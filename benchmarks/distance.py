@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Records a generated project with nested call chains at several values of
+``max_distance``, and prints how many coverage rows are kept for each.
+
+    python benchmarks/distance.py --depth=8 --tests=50
+
+:copyright: 2011 DISQUS.
+:license: BSD
+"""
+
+import os
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from optparse import OptionParser
+from subprocess import check_call
+
+RUNNER = 'import nose; from kleenex.plugin import TestCoveragePlugin; nose.main(addplugins=[TestCoveragePlugin()])'
+
+
+def write_project(path, depth, num_tests):
+    os.mkdir(os.path.join(path, 'app'))
+    os.mkdir(os.path.join(path, 'tests'))
+    open(os.path.join(path, 'app', '__init__.py'), 'w').close()
+    open(os.path.join(path, 'tests', '__init__.py'), 'w').close()
+
+    with open(os.path.join(path, 'app', 'chain.py'), 'w') as fp:
+        for level in xrange(depth):
+            fp.write('def level_%d(value):\n' % level)
+            fp.write('    value += %d\n' % level)
+            if level + 1 < depth:
+                fp.write('    value = level_%d(value)\n' % (level + 1))
+            fp.write('    return value\n\n\n')
+
+    with open(os.path.join(path, 'tests', 'test_chain.py'), 'w') as fp:
+        fp.write('import unittest\n\nfrom app import chain\n\n\n')
+        fp.write('class ChainTest(unittest.TestCase):\n')
+        fp.write('    def setUp(self):\n        self.value = chain.level_%d(0)\n\n' % (depth - 1))
+        for n in xrange(num_tests):
+            fp.write('    def test_%d(self):\n' % n)
+            fp.write('        self.assertTrue(chain.level_0(self.value) >= 0)\n\n')
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--depth', dest='depth', type='int', default=8)
+    parser.add_option('--tests', dest='tests', type='int', default=50)
+    parser.add_option('--distances', dest='distances', default='1,2,4,8,1000')
+    options, args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+    path = tempfile.mkdtemp()
+    try:
+        write_project(path, options.depth, options.tests)
+        with open(os.devnull, 'w') as devnull:
+            check_call(['git', 'init', '-q'], cwd=path)
+            check_call(['git', '-c', 'user.name=kleenex', '-c', 'user.email=kleenex@localhost',
+                        'commit', '-q', '--allow-empty', '-m', 'benchmark'], cwd=path)
+
+            for max_distance in options.distances.split(','):
+                db = os.path.join(path, 'coverage-%s.db' % max_distance)
+                with open(os.path.join(path, 'setup.cfg'), 'w') as fp:
+                    fp.write('[kleenex]\nrecord = true\nreport = false\nparent = HEAD\n')
+                    fp.write('db = sqlite:///%s\nmax_distance = %s\n' % (db, max_distance))
+
+                check_call([sys.executable, '-c', RUNNER, '--with-kleenex', 'tests'],
+                           cwd=path, env=env, stdout=devnull, stderr=devnull)
+
+                conn = sqlite3.connect(db)
+                num_rows = conn.execute('SELECT COUNT(*) FROM coverage').fetchone()[0]
+                num_app_rows = conn.execute("SELECT COUNT(*) FROM coverage WHERE filename LIKE 'app/%'").fetchone()[0]
+                conn.close()
+                print 'max_distance=%-5s rows=%-6d (app=%d)' % (max_distance, num_rows, num_app_rows)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Times ``CoverageDB.record_tests`` against a database using synthetic
+coverage data. Note that this drops and recreates kleenex's tables.
+
+    python benchmarks/record.py postgres://postgres@localhost/kleenex --tests=2000
+
+:copyright: 2011 DISQUS.
+:license: BSD
+"""
+
+import datetime
+import logging
+import random
+import time
+
+from optparse import OptionParser
+
+from kleenex.db import CoverageDB, metadata
+
+
+def generate(num_tests, num_files, num_lines):
+    test_data = {}
+    for n in xrange(num_tests):
+        files = {}
+        for filename in random.sample(xrange(num_files), min(10, num_files)):
+            files['app/module_%d.py' % filename] = dict(
+                (lineno, random.randint(0, 4)) for lineno in random.sample(xrange(1, 1000), num_lines))
+        test_data['tests.test_%d:Test%d.test_%d' % (n / 100, n / 10, n)] = files
+    return test_data
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] dsn')
+    parser.add_option('--tests', dest='tests', type='int', default=1000)
+    parser.add_option('--files', dest='files', type='int', default=100)
+    parser.add_option('--lines', dest='lines', type='int', default=20,
+                      help='Lines recorded per file per test')
+    parser.add_option('--generic', dest='generic', action='store_true', default=False,
+                      help='Force the per-statement record path')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('A DSN is required')
+
+    db = CoverageDB(args[0], logging.getLogger(__name__))
+    metadata.drop_all(db.conn)
+    db.upgrade()
+
+    test_data = generate(options.tests, options.files, options.lines)
+    num_rows = sum(len(l) for f in test_data.itervalues() for l in f.itervalues())
+    print 'Recording %d test(s) with %d coverage row(s)' % (len(test_data), num_rows)
+
+    for attempt in ('initial', 'rerecord'):
+        trans = db.begin()
+        s = time.time()
+        revision_id = db.add_revision('a' * 40, datetime.datetime.now())
+        if options.generic:
+            db._add_tests(revision_id, test_data, {}, False)
+        else:
+            db.record_tests(revision_id, test_data)
+        trans.commit()
+        print '%s: %.2fs' % (attempt, time.time() - s)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Measures the throughput and latency of discovery queries made against a
+``CoverageServer``, using synthetic coverage data. Note that this drops and
+recreates kleenex's tables.
+
+    python benchmarks/server.py sqlite:////tmp/kleenex.db --clients=4 --requests=2000
+
+:copyright: 2011 DISQUS.
+:license: BSD
+"""
+
+import datetime
+import logging
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+
+from kleenex.db import CoverageDB, metadata
+from kleenex.server import CoverageClient, CoverageServer
+
+from record import generate
+
+
+def percentile(values, n):
+    return values[min(len(values) - 1, int(len(values) * n / 100.0))]
+
+
+def run_client(path, revision, num_files, num_requests, timings):
+    client = CoverageClient(path, logging.getLogger(__name__))
+    try:
+        for n in xrange(num_requests):
+            s = time.time()
+            # a typical discovery asks for the revision and then each changed file
+            revision_id = client.get_revision_id(revision)
+            client.get_coverage(revision_id, 'app/module_%d.py' % random.randrange(num_files),
+                                random.sample(xrange(1, 1000), 10))
+            timings.append(time.time() - s)
+    finally:
+        client.close()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] dsn')
+    parser.add_option('--tests', dest='tests', type='int', default=1000)
+    parser.add_option('--files', dest='files', type='int', default=100)
+    parser.add_option('--lines', dest='lines', type='int', default=20)
+    parser.add_option('--clients', dest='clients', type='int', default=4)
+    parser.add_option('--requests', dest='requests', type='int', default=1000,
+                      help='Requests made by each client')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('A DSN is required')
+
+    logger = logging.getLogger(__name__)
+    revision = 'a' * 40
+
+    db = CoverageDB(args[0], logger)
+    metadata.drop_all(db.conn)
+    db.upgrade()
+    trans = db.begin()
+    db.record_tests(db.add_revision(revision, datetime.datetime.now()),
+                    generate(options.tests, options.files, options.lines))
+    trans.commit()
+    db.close()
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'kleenex.sock')
+    server = CoverageServer(path, args[0], logger)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        s = time.time()
+        run_client(path, revision, options.files, 1, [])
+        print 'index load: %.2fs' % (time.time() - s)
+
+        timings = []
+        threads = [threading.Thread(target=run_client, args=(path, revision, options.files, options.requests, timings))
+                   for n in xrange(options.clients)]
+        s = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - s
+
+        timings.sort()
+        print '%d client(s), %d request(s): %.0f req/s, p50=%.2fms p99=%.2fms' % (
+            options.clients, len(timings), len(timings) / elapsed,
+            percentile(timings, 50) * 1000, percentile(timings, 99) * 1000)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
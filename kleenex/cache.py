@@ -0,0 +1,115 @@
+"""
+kleenex.cache
+~~~~~~~~~~~~~
+
+:copyright: 2011 DISQUS.
+:license: BSD
+"""
+
+import hashlib
+import os
+import os.path
+import simplejson
+
+
+def get_diff_hash(diff):
+    """
+    Returns a hash of ``diff`` which ignores details that don't affect
+    selection, such as blob ids and trailing whitespace.
+    """
+    lines = (l.rstrip() for l in diff.splitlines() if not l.startswith('index '))
+    return hashlib.sha1('\n'.join(lines)).hexdigest()
+
+
+class SelectionCache(object):
+    """
+    Memoizes discovered selections keyed by (revision, version, diff hash).
+
+    ``version`` should change whenever coverage is recorded against the
+    revision again (see ``CoverageDB.get_revision_version``), so entries
+    made against older data are never used.
+
+    Entries are always kept as JSON files under ``path``, and when ``db``
+    is given they are also shared through the coverage database.
+    """
+    def __init__(self, path, logger, db=None):
+        self.path = path
+        self.logger = logger
+        self.db = db
+
+    def _get_filename(self, revision, version, diff_hash):
+        return os.path.join(self.path, '%s-%s-%s.json' % (revision, version, diff_hash))
+
+    def get(self, revision, version, diff_hash):
+        filename = self._get_filename(revision, version, diff_hash)
+        try:
+            with open(filename, 'r') as fp:
+                return simplejson.load(fp)
+        except (IOError, ValueError):
+            pass
+
+        if self.db is None:
+            return None
+
+        try:
+            revision_id = self.db.get_revision_id(revision)
+        except ValueError:
+            return None
+
+        data = self.db.get_selection(revision_id, diff_hash)
+        if data is None:
+            return None
+
+        selection = simplejson.loads(data)
+        if selection.get('version') != version:
+            return None
+
+        self._write(filename, data)
+        return selection
+
+    def set(self, revision, version, diff_hash, selection):
+        data = simplejson.dumps(dict(selection, version=version))
+
+        if self.db is not None:
+            from sqlalchemy.exc import IntegrityError
+
+            try:
+                revision_id = self.db.get_revision_id(revision)
+            except ValueError:
+                # the revision was trimmed since we looked it up
+                revision_id = None
+
+            if revision_id is not None:
+                trans = self.db.begin()
+                try:
+                    self.db.add_selection(revision_id, diff_hash, data)
+                    trans.commit()
+                except IntegrityError, e:
+                    # another run stored the same selection concurrently
+                    trans.rollback()
+                    self.logger.warning('Unable to store selection in the database: %s', e)
+
+        self._write(self._get_filename(revision, version, diff_hash), data)
+
+    def evict(self, revisions):
+        "Removes all local entries which don't belong to ``revisions``."
+        if not os.path.isdir(self.path):
+            return 0
+
+        num_evicted = 0
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.json'):
+                continue
+            if filename.split('-', 1)[0] in revisions:
+                continue
+            os.unlink(os.path.join(self.path, filename))
+            num_evicted += 1
+
+        return num_evicted
+
+    def _write(self, filename, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with open(filename, 'w') as fp:
+            fp.write(data)
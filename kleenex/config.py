@@ -21,6 +21,12 @@ def read_config(filename, section='kleenex'):
     max_distance = 4
     test_missing = true
     max_revisions = 100
+    granularity = line
+    selection_cache = none
+    selection_cache_path = .kleenex
+    server =
+    record_files = false
+    entry_functions = setUp, tearDown
     """
     config = RawConfigParser({
         'db': 'sqlite:///coverage.db',
@@ -33,6 +39,12 @@ def read_config(filename, section='kleenex'):
         'max_distance': '4',
         'test_missing': 'true',
         'max_revisions': '100',
+        'granularity': 'line',
+        'selection_cache': 'none',
+        'selection_cache_path': '.kleenex',
+        'server': '',
+        'record_files': 'false',
+        'entry_functions': 'setUp, tearDown',
     }, dict_type=Config)
     config.read(filename)
 
@@ -50,4 +62,10 @@ def read_config(filename, section='kleenex'):
         'max_distance': config.getint(section, 'max_distance'),
         'test_missing': config.getboolean(section, 'test_missing'),
         'max_revisions': config.getint(section, 'max_revisions'),
+        'granularity': config.get(section, 'granularity'),
+        'selection_cache': config.get(section, 'selection_cache'),
+        'selection_cache_path': config.get(section, 'selection_cache_path'),
+        'server': config.get(section, 'server'),
+        'record_files': config.getboolean(section, 'record_files'),
+        'entry_functions': config.get(section, 'entry_functions'),
     })
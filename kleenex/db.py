@@ -9,8 +9,10 @@ import time
 
 from collections import defaultdict
 from sqlalchemy import create_engine, Table, MetaData, Integer, String, \
-  Column, UniqueConstraint, ForeignKey, DateTime
-from sqlalchemy.sql import select
+  Column, UniqueConstraint, ForeignKey, DateTime, Text
+from sqlalchemy.sql import select, and_, or_, func
+
+from kleenex.utils import get_line_ranges
 
 metadata = MetaData()
 Revisions = Table('revisions', metadata,
@@ -22,6 +24,8 @@ Tests = Table('tests', metadata,
     Column('id', Integer, primary_key=True),
     Column('test', String, unique=True),
     Column('revision_id', Integer, ForeignKey('revisions.id'), index=True),
+    # ids must never be reused, as the latest one versions a revision's data
+    sqlite_autoincrement=True,
 )
 Coverage = Table('coverage', metadata,
     Column('id', Integer, primary_key=True),
@@ -32,12 +36,79 @@ Coverage = Table('coverage', metadata,
     Column('revision_id', Integer, ForeignKey('revisions.id'), index=True),
     UniqueConstraint('filename', 'lineno', 'test_id'),
 )
+Functions = Table('functions', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('filename', String),
+    Column('name', String),
+    Column('lineno', Integer),
+    Column('end_lineno', Integer),
+    Column('distance', Integer),
+    Column('test_id', Integer, ForeignKey('tests.id'), index=True),
+    Column('revision_id', Integer, ForeignKey('revisions.id'), index=True),
+    # matches FunctionTracer's key, as several code objects (e.g. a lambda
+    # and a generator expression) can start on the same line
+    UniqueConstraint('filename', 'lineno', 'end_lineno', 'name', 'test_id'),
+)
+Dependencies = Table('dependencies', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('filename', String),
+    Column('test_id', Integer, ForeignKey('tests.id'), index=True),
+    Column('revision_id', Integer, ForeignKey('revisions.id'), index=True),
+    UniqueConstraint('filename', 'test_id'),
+)
+Selections = Table('selections', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('diff_hash', String(40)),
+    Column('data', Text),
+    Column('revision_id', Integer, ForeignKey('revisions.id'), index=True),
+    UniqueConstraint('revision_id', 'diff_hash'),
+)
+
+
+def _copy_value(value):
+    "Formats a value for COPY's text format."
+    if value is None:
+        return '\\N'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+      .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(object):
+    """
+    A file-like object which lazily feeds ``rows`` to ``COPY ... FROM STDIN``.
+    """
+    def __init__(self, rows):
+        self.lines = ('\t'.join(_copy_value(v) for v in row) + '\n' for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if size >= 0 and length >= size:
+                break
+
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    readline = read
 
 
 class CoverageDB(object):
-    def __init__(self, dsn, logger):
+    def __init__(self, dsn, logger, engine=None):
         self.logger = logger
-        self.engine = create_engine(dsn)
+        # an existing engine may be passed in to share its connection pool
+        self.engine = engine or create_engine(dsn)
         self.conn = self._connect_db()
 
     def _connect_db(self):
@@ -50,6 +121,9 @@ class CoverageDB(object):
     def _execute(self, statement, params=None):
         return self.conn.execute(statement, params or [])
 
+    def close(self):
+        self.conn.close()
+
     def upgrade(self):
         metadata.create_all(self.conn, checkfirst=True)
 
@@ -70,9 +144,12 @@ class CoverageDB(object):
     def remove_revision(self, revision_id):
         "Removes all data related to a revision (run in a transaction)."
         trans = self.begin()
-        self._execute(Coverage.delete().where(Tests.c.revision_id == revision_id))
+        self.remove_selections(revision_id)
+        self._execute(Dependencies.delete().where(Dependencies.c.revision_id == revision_id))
+        self._execute(Functions.delete().where(Functions.c.revision_id == revision_id))
+        self._execute(Coverage.delete().where(Coverage.c.revision_id == revision_id))
         self._execute(Tests.delete().where(Tests.c.revision_id == revision_id))
-        self._execute(Revisions.delete().where(Revisions.c.revision_id == revision_id))
+        self._execute(Revisions.delete().where(Revisions.c.id == revision_id))
         trans.commit()
 
     def trim_revisions(self, num_to_keep):
@@ -90,6 +167,10 @@ class CoverageDB(object):
 
         return num_trimmed
 
+    def get_revisions(self):
+        result = self._execute(select([Revisions.c.revision])).fetchall()
+        return set(r[0] for r in result)
+
     def get_revision_id(self, revision):
         statement = select([Revisions.c.id]).where(Revisions.c.revision == revision).limit(1)
         result = self._execute(statement).fetchall()
@@ -99,6 +180,128 @@ class CoverageDB(object):
 
         return result[0][0]
 
+    def get_revision_version(self, revision_id):
+        """
+        Returns a value which changes whenever tests are recorded against a
+        revision (as recording always inserts new test rows).
+        """
+        statement = select([func.max(Tests.c.id)]).where(Tests.c.revision_id == revision_id)
+        return self._execute(statement).scalar()
+
+    def get_revision_tests(self, revision_id):
+        "Returns a list of (test_id, test) for every test recorded against a revision."
+        statement = select([Tests.c.id, Tests.c.test]).where(Tests.c.revision_id == revision_id)
+        return self._execute(statement).fetchall()
+
+    def get_revision_coverage(self, revision_id):
+        "Returns a list of (test_id, filename, lineno) for a revision."
+        statement = select([Coverage.c.test_id, Coverage.c.filename, Coverage.c.lineno])\
+          .where(Coverage.c.revision_id == revision_id)
+        return self._execute(statement).fetchall()
+
+    def get_revision_functions(self, revision_id):
+        "Returns a list of (test_id, filename, lineno, end_lineno) for a revision."
+        statement = select([Functions.c.test_id, Functions.c.filename, Functions.c.lineno,
+                            Functions.c.end_lineno])\
+          .where(Functions.c.revision_id == revision_id)
+        return self._execute(statement).fetchall()
+
+    def get_revision_dependencies(self, revision_id):
+        "Returns a list of (test_id, filename) for a revision."
+        statement = select([Dependencies.c.test_id, Dependencies.c.filename])\
+          .where(Dependencies.c.revision_id == revision_id)
+        return self._execute(statement).fetchall()
+
+    def record_tests(self, revision_id, test_data, file_data=None, functions=False):
+        """
+        Replaces the recorded data for every test in ``test_data``, which
+        should be a dictionary:
+            {test: {filename: linenos}}
+
+        where ``linenos`` is in the format taken by ``add_coverage`` (or by
+        ``add_function_coverage`` when ``functions`` is set). ``file_data``
+        optionally maps tests to the files they depend on.
+
+        This should be run in a transaction.
+        """
+        file_data = file_data or {}
+        # COPY needs psycopg2's copy_expert, so other PostgreSQL drivers
+        # (e.g. pg8000) take the generic path
+        if self.engine.dialect.driver == 'psycopg2':
+            self._copy_tests(revision_id, test_data, file_data, functions)
+        else:
+            self._add_tests(revision_id, test_data, file_data, functions)
+
+    def _add_tests(self, revision_id, test_data, file_data, functions):
+        if functions:
+            add_coverage = self.add_function_coverage
+        else:
+            add_coverage = self.add_coverage
+
+        for test, files in test_data.iteritems():
+            self.remove_test(revision_id, test)
+            test_id = self.add_test(revision_id, test)
+            for filename, linenos in files.iteritems():
+                add_coverage(revision_id, test_id, filename, linenos)
+            if test in file_data:
+                self.add_dependencies(revision_id, test_id, file_data[test])
+
+    def _copy_tests(self, revision_id, test_data, file_data, functions):
+        """
+        Streams everything into temporary staging tables using COPY, and
+        then merges them with a handful of set-based statements.
+        """
+        cursor = self.conn.connection.cursor()
+
+        def copy(table, rows):
+            cursor.copy_expert('COPY %s FROM STDIN' % table, CopyStream(rows))
+
+        cursor.execute('CREATE TEMPORARY TABLE tests_stage (test varchar) ON COMMIT DROP')
+        copy('tests_stage', ((test,) for test in test_data))
+
+        if functions:
+            cursor.execute('CREATE TEMPORARY TABLE functions_stage (test varchar, filename varchar, '
+                           'name varchar, lineno integer, end_lineno integer, distance integer) ON COMMIT DROP')
+            copy('functions_stage', ((test, filename, name, lineno, end_lineno, distance)
+                for test, files in test_data.iteritems()
+                for filename, funcs in files.iteritems()
+                for (lineno, end_lineno, name), distance in funcs.iteritems()))
+        else:
+            cursor.execute('CREATE TEMPORARY TABLE coverage_stage (test varchar, filename varchar, '
+                           'lineno integer, distance integer) ON COMMIT DROP')
+            copy('coverage_stage', ((test, filename, lineno, distance)
+                for test, files in test_data.iteritems()
+                for filename, linenos in files.iteritems()
+                for lineno, distance in linenos.iteritems()))
+
+        cursor.execute('CREATE TEMPORARY TABLE dependencies_stage (test varchar, filename varchar) ON COMMIT DROP')
+        copy('dependencies_stage', ((test, filename)
+            for test, filenames in file_data.iteritems() if test in test_data
+            for filename in filenames))
+
+        cursor.execute('ANALYZE tests_stage')
+
+        # clean up existing tests
+        for table in ('coverage', 'functions', 'dependencies'):
+            cursor.execute('DELETE FROM %s USING tests, tests_stage WHERE %s.test_id = tests.id '
+                           'AND tests.test = tests_stage.test' % (table, table))
+        cursor.execute('DELETE FROM tests USING tests_stage WHERE tests.test = tests_stage.test')
+
+        cursor.execute('INSERT INTO tests (test, revision_id) SELECT test, %s FROM tests_stage', [revision_id])
+        if functions:
+            cursor.execute('INSERT INTO functions (filename, name, lineno, end_lineno, distance, test_id, revision_id) '
+                           'SELECT s.filename, s.name, s.lineno, s.end_lineno, s.distance, t.id, %s '
+                           'FROM functions_stage s JOIN tests t ON t.test = s.test', [revision_id])
+        else:
+            cursor.execute('INSERT INTO coverage (filename, lineno, distance, test_id, revision_id) '
+                           'SELECT s.filename, s.lineno, s.distance, t.id, %s '
+                           'FROM coverage_stage s JOIN tests t ON t.test = s.test', [revision_id])
+        cursor.execute('INSERT INTO dependencies (filename, test_id, revision_id) '
+                       'SELECT s.filename, t.id, %s FROM dependencies_stage s JOIN tests t ON t.test = s.test',
+                       [revision_id])
+
+        cursor.close()
+
     def add_test(self, revision_id, test):
         result = self._execute(Tests.insert().values(test=test, revision_id=revision_id))
         return result.inserted_primary_key[0]
@@ -139,18 +342,44 @@ class CoverageDB(object):
             'revision_id': revision_id,
         } for lineno, distance in linenos.iteritems()])
 
+    def add_function_coverage(self, revision_id, test_id, filename, functions):
+        """
+        functions should be a dictionary:
+            {(lineno, end_lineno, name): distance}
+        """
+        ins = Functions.insert()
+        self._execute(ins, [{
+            'filename': filename,
+            'name': name,
+            'lineno': lineno,
+            'end_lineno': end_lineno,
+            'distance': distance,
+            'test_id': test_id,
+            'revision_id': revision_id,
+        } for (lineno, end_lineno, name), distance in functions.iteritems()])
+
     def remove_coverage(self, revision_id, test_id):
         self._execute(Coverage.delete().where(Coverage.c.test_id == test_id))
+        self._execute(Functions.delete().where(Functions.c.test_id == test_id))
+        self._execute(Dependencies.delete().where(Dependencies.c.test_id == test_id))
 
     def has_coverage(self, revision_id, filename):
-        statement = select([Coverage.c.id])\
-          .where(Coverage.c.filename == filename)\
-          .where(Coverage.c.revision_id == revision_id)\
-          .limit(1)
+        for table in (Coverage, Functions):
+            statement = select([table.c.id])\
+              .where(table.c.filename == filename)\
+              .where(table.c.revision_id == revision_id)\
+              .limit(1)
+
+            if self._execute(statement).fetchall():
+                return True
 
-        return bool(self._execute(statement).fetchall())
+        return False
 
     def get_coverage(self, revision_id, filename, linenos):
+        """
+        Returns the tests which cover any of ``linenos`` in ``filename``,
+        either through line-level or function-level coverage.
+        """
         statement = select([Tests.c.test])\
           .where(Tests.c.id == Coverage.c.test_id)\
           .where(Coverage.c.filename == filename)\
@@ -158,4 +387,56 @@ class CoverageDB(object):
           .where(Coverage.c.lineno.in_(linenos))\
           .distinct()
 
+        result = set(r[0] for r in self._execute(statement).fetchall())
+
+        # match each hunk against the line range of recorded functions
+        hunks = [and_(Functions.c.lineno <= end, Functions.c.end_lineno >= start)
+                 for start, end in get_line_ranges(linenos)]
+        if hunks:
+            statement = select([Tests.c.test])\
+              .where(Tests.c.id == Functions.c.test_id)\
+              .where(Functions.c.filename == filename)\
+              .where(Functions.c.revision_id == revision_id)\
+              .where(or_(*hunks))\
+              .distinct()
+
+            result.update(r[0] for r in self._execute(statement).fetchall())
+
+        return list(result)
+
+    def add_dependencies(self, revision_id, test_id, filenames):
+        "Records that a test reads each of ``filenames``."
+        ins = Dependencies.insert()
+        self._execute(ins, [{
+            'filename': filename,
+            'test_id': test_id,
+            'revision_id': revision_id,
+        } for filename in filenames])
+
+    def get_dependents(self, revision_id, filename):
+        "Returns the tests which read ``filename``."
+        statement = select([Tests.c.test])\
+          .where(Tests.c.id == Dependencies.c.test_id)\
+          .where(Dependencies.c.filename == filename)\
+          .where(Dependencies.c.revision_id == revision_id)\
+          .distinct()
+
         return [r[0] for r in self._execute(statement).fetchall()]
+
+    def add_selection(self, revision_id, diff_hash, data):
+        self._execute(Selections.delete()\
+          .where(Selections.c.revision_id == revision_id)\
+          .where(Selections.c.diff_hash == diff_hash))
+        self._execute(Selections.insert().values(revision_id=revision_id, diff_hash=diff_hash, data=data))
+
+    def get_selection(self, revision_id, diff_hash):
+        statement = select([Selections.c.data])\
+          .where(Selections.c.revision_id == revision_id)\
+          .where(Selections.c.diff_hash == diff_hash)\
+          .limit(1)
+        result = self._execute(statement).fetchone()
+
+        return result[0] if result else None
+
+    def remove_selections(self, revision_id):
+        self._execute(Selections.delete().where(Selections.c.revision_id == revision_id))
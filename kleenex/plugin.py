@@ -12,22 +12,21 @@ import datetime
 import inspect
 import logging
 import os
-import simplejson
 import sys
 import time
 
-from coverage import coverage
-from coverage.report import Reporter
 from collections import defaultdict
+from nose.case import FunctionTestCase, MethodTestCase
 from nose.plugins.base import Plugin
 from subprocess import Popen, PIPE, STDOUT
 
 from kleenex.config import read_config
-from kleenex.db import CoverageDB
-from kleenex.diff import DiffParser
-from kleenex.tracer import ExtendedTracer
 from kleenex.utils import is_py_script
 
+# nose imports this module on every run, so anything heavy (coverage,
+# SQLAlchemy, etc.) is only imported once the plugin is enabled and the
+# configured mode actually needs it.
+
 
 class TestCoveragePlugin(Plugin):
     """
@@ -46,23 +45,61 @@ class TestCoveragePlugin(Plugin):
     score = 0
     name = 'kleenex'
 
-    def _get_name_from_test(self, test):
-        test_method_name = test._testMethodName
-
+    def _get_class_test_name(self, cls, method_name):
         # We need to determine the *actual* test path (as thats what nose gives us in wantMethod)
         # for example, maybe a test was imported in foo.bar.tests, but originated as foo.bar.something.MyTest
         # in this case, we'd need to identify that its *actually* foo.bar.something.MyTest to record the
         # proper coverage
-        test_ = getattr(sys.modules[test.__module__], test.__class__.__name__)
+        cls = getattr(sys.modules[cls.__module__], cls.__name__)
 
-        test_name = '%s:%s.%s' % (test_.__module__, test_.__name__,
-                                                     test_method_name)
+        return '%s:%s.%s' % (cls.__module__, cls.__name__, method_name)
 
-        return test_name
+    def _get_function_test_name(self, function):
+        return '%s:%s' % (function.__module__, function.__name__)
+
+    def _get_name_from_test(self, test):
+        # Generated tests are recorded under their generator (the descriptor), as
+        # that's what nose gives us in wantFunction/wantMethod
+        if isinstance(test, FunctionTestCase):
+            return self._get_function_test_name(test.descriptor or test.test)
+
+        if isinstance(test, MethodTestCase):
+            method = test.descriptor or test.method
+            return self._get_class_test_name(test.cls, method.__name__)
+
+        return self._get_class_test_name(test.__class__, test._testMethodName)
+
+    def _get_entry_from_test(self, test):
+        """
+        Returns the (code, name) of the test's own frame.
+
+        When the callable which nose runs for ``test`` is a decorator's
+        wrapper, its code isn't the test's, so ``code`` is None and the
+        test's frame can only be matched by ``name``.
+        """
+        if isinstance(test, (FunctionTestCase, MethodTestCase)):
+            func = test.test
+            func = getattr(func, 'im_func', func)
+            name = getattr(func, '__name__', None)
+        else:
+            func = getattr(test, test._testMethodName, None)
+            func = getattr(func, 'im_func', func)
+            name = test._testMethodName
+
+        code = getattr(func, 'func_code', None)
+        if code is not None and code.co_name != name:
+            code = None
+        return code, name
 
     def _setup_coverage(self):
+        from coverage import coverage
+        from kleenex.tracer import ExtendedTracer, FunctionTracer
+
         instance = coverage(include=os.path.join(os.getcwd(), '*'))
-        instance.collector._trace_class = ExtendedTracer
+        if self.config.granularity == 'function':
+            instance.collector._trace_class = FunctionTracer
+        else:
+            instance.collector._trace_class = ExtendedTracer
         instance.use_cache(False)
 
         return instance
@@ -82,16 +119,24 @@ class TestCoveragePlugin(Plugin):
         self.config = config
 
         assert not (self.config.discover and self.config.record), "You cannot use both `record` and `discover` options."
+        assert self.config.granularity in ('line', 'function'), "`granularity` must be one of `line` or `function`."
+        assert self.config.selection_cache in ('none', 'local', 'db'), "`selection_cache` must be one of `none`, `local` or `db`."
+        assert not (self.config.server and self.config.selection_cache == 'db'), "You cannot use a `db` selection cache with `server`."
 
         self.logger = logging.getLogger(__name__)
 
+        self.entry_names = frozenset(n.strip() for n in config.entry_functions.split(',') if n.strip())
+
         self.pending_funcs = set()
         # diff is a mapping of filename->set(linenos)
         self.diff_data = defaultdict(set)
         # cov is a mapping of filename->set(linenos)
         self.cov_data = defaultdict(set)
-        # test test_name->dict(filename->set(linenos))
+        # test test_name->dict(filename->dict(lineno->distance)), or when
+        # recording functions, test_name->dict(filename->dict((lineno, end_lineno, name)->distance))
         self.test_data = defaultdict(dict)
+        # test_name->set(filenames) of non-python files read by a test
+        self.file_data = defaultdict(set)
 
         report_output = config.report_output
         if not report_output or report_output == '-':
@@ -105,14 +150,41 @@ class TestCoveragePlugin(Plugin):
 
     def begin(self):
         # XXX: this is pretty hacky
-        self.db = CoverageDB(self.config.db, self.logger)
+        self.db = None
+        self.selection_cache = None
+        if self.config.server and self.config.discover:
+            import socket
+            from kleenex.server import CoverageClient
+
+            try:
+                self.db = CoverageClient(self.config.server, self.logger)
+            except socket.error, e:
+                self.logger.warning('Unable to connect to kleenex server at %s (%s), using database', self.config.server, e)
+        if self.db is None and (self.config.discover or self.config.record):
+            # reporting alone never touches the database
+            from kleenex.db import CoverageDB
+
+            self.db = CoverageDB(self.config.db, self.logger)
         if self.config.record:
             self.db.upgrade()
 
+        if self.db is not None and self.config.selection_cache != 'none':
+            from kleenex.cache import SelectionCache
+
+            self.selection_cache = SelectionCache(self.config.selection_cache_path, self.logger,
+                db=self.db if self.config.selection_cache == 'db' else None)
+
         if self.config.report or self.config.record:
             # If we're recording coverage we need to ensure it gets reset
             self.coverage = self._setup_coverage()
 
+        if self.config.record and self.config.record_files:
+            from kleenex.tracer import FileTracker
+
+            self.file_tracker = FileTracker(os.getcwd())
+        else:
+            self.file_tracker = None
+
         if not (self.config.discover or self.config.record):
             return
 
@@ -140,10 +212,29 @@ class TestCoveragePlugin(Plugin):
 
         pending_funcs = self.pending_funcs
 
+        if self.config.discover and self.selection_cache:
+            from kleenex.cache import get_diff_hash
+
+            diff_hash = get_diff_hash(diff)
+            version = self.db.get_revision_version(self.revision_id)
+            selection = self.selection_cache.get(self.revision, version, diff_hash)
+            if selection is not None:
+                for filename, linenos in selection['diff'].iteritems():
+                    self.diff_data[filename].update(linenos)
+                pending_funcs.update(selection['tests'])
+                for filename in selection['missing']:
+                    self._handle_missing_coverage(filename)
+                self.logger.info("Loaded cached selection in %.2fs with %d test(s)", time.time() - s, len(pending_funcs))
+                return
+
+        from kleenex.diff import DiffParser
+
         parser = DiffParser(diff)
         files = list(parser.parse())
 
         diff = self.diff_data
+        # non-python files which changed
+        data_files = set()
         s = time.time()
         for file in files:
             # we dont care about headers
@@ -152,6 +243,9 @@ class TestCoveragePlugin(Plugin):
 
             # file was removed
             if file['new_filename'] == '/dev/null':
+                filename = file['old_filename']
+                if filename.startswith('a/') and not filename.endswith('.py'):
+                    data_files.add(filename[2:])
                 continue
 
             is_new_file = (file['old_filename'] == '/dev/null')
@@ -166,8 +260,9 @@ class TestCoveragePlugin(Plugin):
 
             filename = filename[2:]
 
-            # Ignore non python files
+            # Non python files can only be selected through recorded dependencies
             if not is_py_script(filename):
+                data_files.add(filename)
                 continue
 
             # file is new, only record diff state
@@ -188,21 +283,37 @@ class TestCoveragePlugin(Plugin):
         if self.config.discover:
             self.logger.info("Finding coverage for %d file(s)", len(files))
 
+            missing = []
             for filename, linenos in diff.iteritems():
                 test_coverage = self.db.get_coverage(self.revision_id, filename, linenos)
                 if not test_coverage:
                     # check if we have any coverage recorded
                     if not self.db.has_coverage(self.revision_id, filename):
-                        if self.config.skip_missing:
-                            self.logger.warning('%s has no test coverage recorded', filename)
-                            continue
-                        raise AssertionError("Missing test coverage for %s" % filename)
+                        missing.append(filename)
+                        self._handle_missing_coverage(filename)
                 else:
                     for test in test_coverage:
                         pending_funcs.add(test)
 
+            for filename in data_files:
+                pending_funcs.update(self.db.get_dependents(self.revision_id, filename))
+
             self.logger.info("Determined available coverage in %.2fs with %d test(s)", time.time() - s, len(pending_funcs))
 
+            if self.selection_cache:
+                self.selection_cache.evict(self.db.get_revisions())
+                self.selection_cache.set(self.revision, version, diff_hash, {
+                    'diff': dict((k, list(v)) for k, v in diff.iteritems()),
+                    'tests': list(pending_funcs),
+                    'missing': missing,
+                })
+
+    def _handle_missing_coverage(self, filename):
+        if self.config.skip_missing:
+            self.logger.warning('%s has no test coverage recorded', filename)
+            return
+        raise AssertionError("Missing test coverage for %s" % filename)
+
     def report(self, stream):
         if self.config.record:
             self._record_test_coverage()
@@ -219,6 +330,8 @@ class TestCoveragePlugin(Plugin):
             s = time.time()
             num_revisions = self.db.trim_revisions(self.config.max_revisions)
             self.logger.info("%d revision(s) were trimmed in %.2fs", num_revisions, time.time() - s)
+            if num_revisions and self.selection_cache:
+                self.selection_cache.evict(self.db.get_revisions())
 
         # Use our current revision
         self.logger.info("Recording current revision")
@@ -228,12 +341,15 @@ class TestCoveragePlugin(Plugin):
         revision_id = self.db.add_revision(self.revision, commit_date)
         self.logger.info("Current revision recorded as %s (commit date of %s)", self.revision, commit_date)
 
+        # Any selections made against this revision are now stale
+        self.db.remove_selections(revision_id)
+
         # Finally record tests and their coverage
-        for test_name, files in self.test_data.iteritems():
-            self.db.remove_test(revision_id, test_name)
-            test_id = self.db.add_test(revision_id, test_name)
-            for filename, linenos in files.iteritems():
-                self.db.add_coverage(revision_id, test_id, filename, linenos)
+        self.logger.info("Recording coverage for %d test(s)", len(self.test_data))
+        s = time.time()
+        self.db.record_tests(revision_id, self.test_data, self.file_data,
+                             functions=self.config.granularity == 'function')
+        self.logger.info("Recorded coverage in %.2fs", time.time() - s)
 
         trans.commit()
 
@@ -253,6 +369,8 @@ class TestCoveragePlugin(Plugin):
             missing[filename] = linenos.difference(covered_linenos)
 
         if self.report_file:
+            import simplejson
+
             self.report_file.write(simplejson.dumps({
                 'stats': {
                     'covered': covered,
@@ -274,23 +392,23 @@ class TestCoveragePlugin(Plugin):
                         continue
                     stream.writeln('%-35s   %s' % (filename, ', '.join(map(str, sorted(linenos)))))
 
-    def wantMethod(self, method):
-        if not self.config.discover:
-            return
-
-        # only works with unittest compatible functions currently
-        method_name = method.__name__
-        method = getattr(sys.modules[method.im_class.__module__], method.im_class.__name__)
-        test_name = '%s:%s.%s' % (method.__module__, method.__name__, method_name)
+    def _is_test(self, obj):
+        "Mirrors nose's own selection, so we only ever answer for actual tests."
+        declared = getattr(obj, '__test__', None)
+        if declared is not None:
+            return declared
+        return bool(self.conf.testMatch.search(obj.__name__))
 
+    def _want_test(self, test_name, source):
         # test has coverage for diff
         if test_name in self.pending_funcs:
             return True
 
         # check if this test was modified (e.g. added/changed)
-        diff_data = self.diff_data[inspect.getfile(method)]
+        filename = inspect.getsourcefile(source)
+        diff_data = self.diff_data.get(os.path.relpath(filename)) if filename else None
         if diff_data:
-            lines, startlineno = inspect.getsourcelines(method)
+            lines, startlineno = inspect.getsourcelines(source)
             for lineno in xrange(startlineno, len(lines) + startlineno):
                 if lineno in diff_data:
                     self.pending_funcs.add(test_name)
@@ -305,11 +423,39 @@ class TestCoveragePlugin(Plugin):
 
         return False
 
+    def wantFunction(self, function):
+        if not self.config.discover or not self._is_test(function):
+            return
+
+        # this includes generator functions, which is what their tests are recorded as
+        return self._want_test(self._get_function_test_name(function), function)
+
+    def wantMethod(self, method):
+        if not self.config.discover or not self._is_test(method):
+            return
+
+        # works with both unittest and plain test classes
+        cls = method.im_class
+        test_name = self._get_class_test_name(cls, method.__name__)
+
+        # changes anywhere in the class (e.g. setUp) select its tests
+        return self._want_test(test_name, cls)
+
     def startTest(self, test):
         if not (self.config.record or self.config.report):
             return
 
         self.coverage.start()
+        # distance is measured from the test's own frame
+        code, name = self._get_entry_from_test(test.test)
+        entry_codes = frozenset([code]) if code else frozenset()
+        entry_names = self.entry_names | frozenset([name]) if name else self.entry_names
+        for tracer in self.coverage.collector.tracers:
+            tracer.entry_codes = entry_codes
+            tracer.entry_names = entry_names
+
+        if self.file_tracker:
+            self.file_tracker.start()
 
     def stopTest(self, test):
         if not (self.config.record or self.config.report):
@@ -317,12 +463,16 @@ class TestCoveragePlugin(Plugin):
 
         cov = self.coverage
         cov.stop()
+        if self.file_tracker:
+            self.file_tracker.stop()
 
         # this must have been imported under a different name
         # if self.discover and test_name not in self.pending_funcs:
         #     self.logger.warning("Unable to determine origin for test: %s", test_name)
         #     return
 
+        from coverage.report import Reporter
+
         # initialize reporter
         rep = Reporter(cov)
 
@@ -340,6 +490,11 @@ class TestCoveragePlugin(Plugin):
             test_name = self._get_name_from_test(test_)
             test_data = self.test_data[test_name]
 
+            if self.file_tracker:
+                if self.file_tracker.files:
+                    self.file_data[test_name].update(self.file_tracker.files)
+                self.file_tracker.reset()
+
         for cu in rep.code_units:
             # if sys.modules[test_.__module__].__file__ == cu.filename:
             #     continue
@@ -347,13 +502,22 @@ class TestCoveragePlugin(Plugin):
             linenos = cov.data.executed_lines(cu.filename)
 
             if self.config.record:
-                linenos_in_prox = dict((k, v) for k, v in linenos.iteritems() if v < self.config.max_distance)
+                linenos_in_prox = dict((k, v) for k, v in linenos.iteritems() if v <= self.config.max_distance)
                 if linenos_in_prox:
-                    test_data[filename] = linenos_in_prox
+                    # each test from a generator is recorded under the same
+                    # name, so keep the shortest distance seen by any of them
+                    file_data = test_data.setdefault(filename, {})
+                    for key, distance in linenos_in_prox.iteritems():
+                        if key not in file_data or distance < file_data[key]:
+                            file_data[key] = distance
 
             if self.config.report:
                 diff = self.diff_data[filename]
-                cov_linenos = [l for l in linenos if l in diff]
+                if self.config.granularity == 'function':
+                    # any changed line within an executed function counts as covered
+                    cov_linenos = [l for l in diff if any(k[0] <= l <= k[1] for k in linenos)]
+                else:
+                    cov_linenos = [l for l in linenos if l in diff]
                 if cov_linenos:
                     self.cov_data[filename].update(cov_linenos)
 
@@ -0,0 +1,287 @@
+"""
+kleenex.server
+~~~~~~~~~~~~~~
+
+A long-lived process which answers discovery queries from an in-memory
+index, so that each test run doesn't need to connect to and query the
+coverage database itself.
+
+The protocol is newline delimited JSON over a Unix socket. Each request is
+``{"method": ..., "args": [...]}`` and is answered with either
+``{"result": ...}`` or ``{"error": ..., "type": ...}``.
+
+:copyright: 2011 DISQUS.
+:license: BSD
+"""
+
+import logging
+import os
+import os.path
+import simplejson
+import socket
+import threading
+import time
+
+from collections import defaultdict
+from optparse import OptionParser
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+from kleenex.config import read_config
+from kleenex.utils import get_line_ranges
+
+
+class CoverageIndex(object):
+    """
+    An inverted index of the coverage recorded against a single revision.
+    """
+    # set by the server to track when the index needs reloading
+    version = None
+    checked_at = 0
+
+    def __init__(self, db, revision_id):
+        tests = dict(db.get_revision_tests(revision_id))
+        self.tests = set(tests.itervalues())
+
+        # filename->dict(lineno->set(tests))
+        self.lines = defaultdict(lambda: defaultdict(set))
+        for test_id, filename, lineno in db.get_revision_coverage(revision_id):
+            self.lines[filename][lineno].add(tests[test_id])
+
+        # filename->list((lineno, end_lineno, test))
+        self.functions = defaultdict(list)
+        for test_id, filename, lineno, end_lineno in db.get_revision_functions(revision_id):
+            self.functions[filename].append((lineno, end_lineno, tests[test_id]))
+
+        # filename->set(tests)
+        self.dependents = defaultdict(set)
+        for test_id, filename in db.get_revision_dependencies(revision_id):
+            self.dependents[filename].add(tests[test_id])
+
+    def get_coverage(self, filename, linenos):
+        result = set()
+
+        file_lines = self.lines.get(filename)
+        if file_lines:
+            for lineno in linenos:
+                result.update(file_lines.get(lineno, ()))
+
+        file_functions = self.functions.get(filename)
+        if file_functions:
+            for start, end in get_line_ranges(linenos):
+                result.update(t for l, e, t in file_functions if l <= end and e >= start)
+
+        return list(result)
+
+    def get_dependents(self, filename):
+        return list(self.dependents.get(filename, ()))
+
+    def has_coverage(self, filename):
+        return filename in self.lines or filename in self.functions
+
+    def has_test(self, test):
+        return test in self.tests
+
+
+class CoverageRequestHandler(StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            try:
+                request = simplejson.loads(line)
+                method = request['method']
+                if method not in server.methods:
+                    raise ValueError('Unknown method: %s' % method)
+                response = {'result': getattr(server, method)(*request.get('args', ()))}
+            except Exception, e:
+                if not isinstance(e, ValueError):
+                    server.logger.exception('Unable to handle request: %r', line)
+                response = {'error': unicode(e), 'type': type(e).__name__}
+
+            self.wfile.write(simplejson.dumps(response) + '\n')
+
+    def finish(self):
+        StreamRequestHandler.finish(self)
+        self.server.close_db()
+
+
+class CoverageServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Serves the subset of ``CoverageDB`` which is used by discovery, loading
+    the coverage for a revision into memory the first time it's requested.
+
+    A loaded index is reused for ``check_interval`` seconds, after which the
+    revision's version is checked again and the index is reloaded if
+    coverage has been recorded against it since.
+    """
+    daemon_threads = True
+    max_indexes = 10
+    check_interval = 5
+    methods = ('get_revision_id', 'get_revision_version', 'get_revisions', 'get_coverage',
+               'get_dependents', 'has_coverage', 'has_test')
+
+    def __init__(self, path, dsn, logger):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        UnixStreamServer.__init__(self, path, CoverageRequestHandler)
+        # imported here so that clients don't need to load SQLAlchemy
+        from sqlalchemy import create_engine
+
+        self.dsn = dsn
+        self.logger = logger
+        self.engine = create_engine(dsn)
+        self.indexes = {}
+        self.lock = threading.Lock()
+        # connections can't be shared between request threads, so each
+        # checks out its own from the engine's pool
+        self.local = threading.local()
+
+    def _get_db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            from kleenex.db import CoverageDB
+
+            db = self.local.db = CoverageDB(self.dsn, self.logger, engine=self.engine)
+        return db
+
+    def close_db(self):
+        "Returns the current thread's connection to the pool."
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def _get_index(self, revision_id):
+        index = self.indexes.get(revision_id)
+        if index is not None and time.time() - index.checked_at < self.check_interval:
+            return index
+
+        with self.lock:
+            index = self.indexes.get(revision_id)
+            now = time.time()
+            if index is not None and now - index.checked_at < self.check_interval:
+                return index
+
+            db = self._get_db()
+            version = db.get_revision_version(revision_id)
+            if index is not None and index.version == version:
+                index.checked_at = now
+                return index
+
+            self.logger.info('Loading coverage index for revision %s', revision_id)
+            s = time.time()
+            if index is None and len(self.indexes) >= self.max_indexes:
+                # revision ids are sequential, so drop the oldest
+                del self.indexes[min(self.indexes)]
+            index = CoverageIndex(db, revision_id)
+            index.version, index.checked_at = version, now
+            self.indexes[revision_id] = index
+            self.logger.info('Loaded coverage index in %.2fs', time.time() - s)
+            return index
+
+    def get_revision_id(self, revision):
+        # not cached, as revisions are trimmed and recorded independently
+        return self._get_db().get_revision_id(revision)
+
+    def get_revision_version(self, revision_id):
+        return self._get_db().get_revision_version(revision_id)
+
+    def get_revisions(self):
+        return list(self._get_db().get_revisions())
+
+    def get_coverage(self, revision_id, filename, linenos):
+        return self._get_index(revision_id).get_coverage(filename, linenos)
+
+    def get_dependents(self, revision_id, filename):
+        return self._get_index(revision_id).get_dependents(filename)
+
+    def has_coverage(self, revision_id, filename):
+        return self._get_index(revision_id).has_coverage(filename)
+
+    def has_test(self, revision_id, test):
+        return self._get_index(revision_id).has_test(test)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        self.engine.dispose()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class CoverageClient(object):
+    """
+    Talks to a ``CoverageServer``, exposing the same discovery methods as
+    ``CoverageDB``.
+    """
+    def __init__(self, path, logger):
+        self.logger = logger
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def _call(self, method, *args):
+        self.sock.sendall(simplejson.dumps({'method': method, 'args': args}) + '\n')
+        response = simplejson.loads(self.rfile.readline())
+        if 'error' in response:
+            if response['type'] == 'ValueError':
+                raise ValueError(response['error'])
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def get_revision_id(self, revision):
+        return self._call('get_revision_id', revision)
+
+    def get_revision_version(self, revision_id):
+        return self._call('get_revision_version', revision_id)
+
+    def get_revisions(self):
+        return set(self._call('get_revisions'))
+
+    def get_coverage(self, revision_id, filename, linenos):
+        return self._call('get_coverage', revision_id, filename, list(linenos))
+
+    def get_dependents(self, revision_id, filename):
+        return self._call('get_dependents', revision_id, filename)
+
+    def has_coverage(self, revision_id, filename):
+        return self._call('has_coverage', revision_id, filename)
+
+    def has_test(self, revision_id, test):
+        return self._call('has_test', revision_id, test)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option("--kleenex-config", dest="kleenex_config", default="setup.cfg")
+    parser.add_option("--kleenex-config-section", dest="kleenex_config_section", default="kleenex")
+    parser.add_option("--socket", dest="socket", help="Path of the Unix socket to listen on (defaults to `server`)")
+    options, args = parser.parse_args()
+
+    config = read_config(options.kleenex_config, options.kleenex_config_section)
+    path = options.socket or config.server
+    if not path:
+        parser.error('No socket path configured; pass --socket or set `server`.')
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    server = CoverageServer(path, config.db, logger)
+    logger.info('Listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,62 @@ kleenex.tracer
 :license: BSD
 """
 
+import __builtin__
+import io
+import os.path
+import sys
+
 from coverage.collector import PyTracer
 
 
-class ExtendedTracer(PyTracer):
+def get_last_lineno(code):
+    "Returns the last line number which belongs to a code object."
+    lineno = code.co_firstlineno
+    # co_lnotab is a sequence of (bytecode offset, line) increments
+    for incr in code.co_lnotab[1::2]:
+        lineno += ord(incr)
+    return lineno
+
+
+# Distance recorded for anything executed outside of an entry frame, which
+# is larger than any ``max_distance``.
+NO_DISTANCE = sys.maxint
+
+
+class EntryTracer(PyTracer):
+    """
+    Base for tracers which measure call distance relative to an entry frame
+    (generally the test itself) rather than the absolute stack depth, which
+    depends on the test runner.
+
+    A frame is an entry frame when its code is one of ``entry_codes`` or its
+    function name is one of ``entry_names``. Frames called from within an
+    entry frame are at a distance of one more than their caller, and
+    anything executed outside of one is at ``NO_DISTANCE``.
+    """
+    entry_codes = frozenset()
+    entry_names = frozenset()
+
     def __init__(self):
         PyTracer.__init__(self)
-        self.frame_depth = 0
+        # len(self.data_stack) when the current entry frame was called
+        self.entry_depth = None
+        self.frame_depth = NO_DISTANCE
+
+    def _enter(self, code, depth):
+        "Returns the distance of a newly called frame at ``depth``."
+        if self.entry_depth is None:
+            if code not in self.entry_codes and code.co_name not in self.entry_names:
+                return NO_DISTANCE
+            self.entry_depth = depth
+        return depth - self.entry_depth
+
+    def _leave(self):
+        if self.entry_depth is not None and len(self.data_stack) < self.entry_depth:
+            self.entry_depth = None
 
+
+class ExtendedTracer(EntryTracer):
     def _trace(self, frame, event, arg_unused):
         """The trace function passed to sys.settrace."""
 
@@ -27,12 +75,14 @@ class ExtendedTracer(PyTracer):
                     pair = (self.last_line, -self.last_exc_firstlineno)
                     self.cur_file_data[pair] = self.frame_depth
                 self.cur_file_data, self.last_line, self.frame_depth = self.data_stack.pop()
+                self._leave()
             self.last_exc_back = None
 
         if event == 'call':
             # Entering a new function context.  Decide if we should trace
             # in this file.
-            self.data_stack.append((self.cur_file_data, self.last_line, len(self.data_stack)))
+            self.data_stack.append((self.cur_file_data, self.last_line, self.frame_depth))
+            self.frame_depth = self._enter(frame.f_code, len(self.data_stack))
             filename = frame.f_code.co_filename
             tracename = self.should_trace_cache.get(filename)
             if tracename is None:
@@ -50,14 +100,16 @@ class ExtendedTracer(PyTracer):
             # code block, indicated by (-1, n).
             self.last_line = -1
         elif event == 'line':
-            # Record an executed line.
+            # Record an executed line at the shortest distance it was seen
             if self.cur_file_data is not None:
                 if self.arcs:
                     #print("lin", self.last_line, frame.f_lineno)
-                    self.cur_file_data[(self.last_line, frame.f_lineno)] = self.frame_depth
+                    key = (self.last_line, frame.f_lineno)
                 else:
                     #print("lin", frame.f_lineno)
-                    self.cur_file_data[frame.f_lineno] = self.frame_depth
+                    key = frame.f_lineno
+                if self.frame_depth < self.cur_file_data.get(key, NO_DISTANCE + 1):
+                    self.cur_file_data[key] = self.frame_depth
             self.last_line = frame.f_lineno
         elif event == 'return':
             if self.arcs and self.cur_file_data:
@@ -65,9 +117,105 @@ class ExtendedTracer(PyTracer):
                 self.cur_file_data[(self.last_line, -first)] = self.frame_depth
             # Leaving this function, pop the filename stack.
             self.cur_file_data, self.last_line, self.frame_depth = self.data_stack.pop()
+            self._leave()
             #print("returned, stack is %d deep" % (len(self.data_stack)))
         elif event == 'exception':
             #print("exc", self.last_line, frame.f_lineno)
             self.last_exc_back = frame.f_back
             self.last_exc_firstlineno = frame.f_code.co_firstlineno
         return self._trace
+
+
+class FunctionTracer(EntryTracer):
+    """
+    A low-overhead tracer which only looks at function calls.
+
+    Rather than individual lines, ``data`` holds a mapping of
+    ``(first_lineno, last_lineno, name)`` for every code object that
+    was entered, to the minimal distance at which it was seen.
+
+    This hooks ``sys.setprofile`` instead of ``sys.settrace`` so line
+    events are never generated.
+    """
+    def __init__(self):
+        EntryTracer.__init__(self)
+        self.code_cache = {}
+
+    def _profile(self, frame, event, arg_unused):
+        if event == 'call':
+            self.data_stack.append(None)
+            code = frame.f_code
+            distance = self._enter(code, len(self.data_stack))
+            filename = code.co_filename
+            tracename = self.should_trace_cache.get(filename)
+            if tracename is None:
+                tracename = self.should_trace(filename, frame)
+                self.should_trace_cache[filename] = tracename
+            if not tracename:
+                return
+
+            key = self.code_cache.get(code)
+            if key is None:
+                key = (code.co_firstlineno, get_last_lineno(code), code.co_name)
+                self.code_cache[code] = key
+
+            if tracename not in self.data:
+                self.data[tracename] = {}
+            file_data = self.data[tracename]
+            if distance < file_data.get(key, NO_DISTANCE + 1):
+                file_data[key] = distance
+        elif event == 'return':
+            # We'll see returns for frames which were entered before we
+            # started profiling
+            if self.data_stack:
+                self.data_stack.pop()
+                self._leave()
+
+    def start(self):
+        sys.setprofile(self._profile)
+        return self._profile
+
+    def stop(self):
+        sys.setprofile(None)
+
+
+class FileTracker(object):
+    """
+    Records which files within ``root`` are opened for reading while
+    active, by wrapping the builtin ``open`` and ``io.open``.
+
+    Python sources are ignored as they're already covered by tracing.
+    """
+    ignored_extensions = ('.py', '.pyc', '.pyo')
+
+    def __init__(self, root):
+        self.root = os.path.join(os.path.abspath(root), '')
+        self.files = set()
+        self._builtin_open = __builtin__.open
+        self._io_open = io.open
+
+    def _wrap(self, func):
+        root = self.root
+        files = self.files
+        ignored_extensions = self.ignored_extensions
+
+        def wrapped(name, *args, **kwargs):
+            if isinstance(name, basestring):
+                mode = args[0] if args else kwargs.get('mode', 'r')
+                if 'r' in mode and not name.endswith(ignored_extensions):
+                    path = os.path.abspath(name)
+                    if path.startswith(root):
+                        files.add(path[len(root):])
+            return func(name, *args, **kwargs)
+        return wrapped
+
+    def start(self):
+        __builtin__.open = self._wrap(self._builtin_open)
+        io.open = self._wrap(self._io_open)
+
+    def stop(self):
+        __builtin__.open = self._builtin_open
+        io.open = self._io_open
+
+    def reset(self):
+        self.files.clear()
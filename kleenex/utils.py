@@ -15,3 +15,14 @@ def is_py_script(filename):
             return "#!" in first_line and "python" in first_line
         except StopIteration:
             return False
+
+
+def get_line_ranges(linenos):
+    "Collapses a set of line numbers into a list of (start, end) ranges."
+    ranges = []
+    for lineno in sorted(linenos):
+        if ranges and ranges[-1][1] + 1 >= lineno:
+            ranges[-1][1] = lineno
+        else:
+            ranges.append([lineno, lineno])
+    return [tuple(r) for r in ranges]
@@ -23,7 +23,10 @@ setup(
     entry_points={
        'nose.plugins.0.10': [
             'kleenex = kleenex.plugin:TestCoveragePlugin'
-        ]
+        ],
+       'console_scripts': [
+            'kleenex-server = kleenex.server:main'
+        ],
     },
     license='Apache License 2.0',
     tests_require=tests_require,
@@ -0,0 +1,62 @@
+from unittest2 import TestCase
+
+from kleenex.cache import SelectionCache
+from kleenex.db import CoverageDB, Selections
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+
+class RacingCoverageDB(CoverageDB):
+    "Inserts a selection without replacing, as if another run got there first."
+    def add_selection(self, revision_id, diff_hash, data):
+        self._execute(Selections.insert().values(revision_id=revision_id, diff_hash=diff_hash, data=data))
+
+
+class SelectionCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.logger = logging.getLogger(__name__)
+        self.db = RacingCoverageDB('sqlite:///test.db', self.logger)
+        self.db.upgrade()
+        self.revision = 'a' * 40
+        self.db.add_revision(self.revision, datetime.datetime(2012, 1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        os.unlink('test.db')
+
+    def test_local(self):
+        cache = SelectionCache(self.path, self.logger)
+        self.assertEquals(cache.get(self.revision, 1, 'b' * 40), None)
+
+        cache.set(self.revision, 1, 'b' * 40, {'tests': ['foo']})
+        self.assertEquals(cache.get(self.revision, 1, 'b' * 40)['tests'], ['foo'])
+        self.assertEquals(cache.get(self.revision, 2, 'b' * 40), None)
+
+        self.assertEquals(cache.evict(set([self.revision])), 0)
+        self.assertEquals(cache.evict(set()), 1)
+        self.assertEquals(cache.get(self.revision, 1, 'b' * 40), None)
+
+    def test_db_ignores_other_versions(self):
+        SelectionCache(self.path, self.logger, db=self.db).set(self.revision, 1, 'b' * 40, {'tests': ['foo']})
+
+        cache = SelectionCache(tempfile.mkdtemp(dir=self.path), self.logger, db=self.db)
+        self.assertEquals(cache.get(self.revision, 2, 'b' * 40), None)
+        self.assertEquals(cache.get(self.revision, 1, 'b' * 40)['tests'], ['foo'])
+
+    def test_db_conflict_is_not_fatal(self):
+        cache = SelectionCache(self.path, self.logger, db=self.db)
+        cache.set(self.revision, 1, 'b' * 40, {'tests': ['foo']})
+        cache.set(self.revision, 2, 'b' * 40, {'tests': ['bar']})
+
+        self.assertEquals(cache.get(self.revision, 2, 'b' * 40)['tests'], ['bar'])
+
+    def test_db_trimmed_revision_is_not_fatal(self):
+        cache = SelectionCache(self.path, self.logger, db=self.db)
+        cache.set('c' * 40, 1, 'b' * 40, {'tests': ['foo']})
+
+        self.assertEquals(cache.get('c' * 40, 1, 'b' * 40)['tests'], ['foo'])
@@ -1,8 +1,10 @@
-from unittest2 import TestCase
+from unittest2 import TestCase, skipUnless
 
-from kleenex.db import CoverageDB
+from kleenex.db import CoverageDB, metadata
 
+import datetime
 import logging
+import os
 import os.path
 
 
@@ -18,3 +20,123 @@ class CoverageDBTest(TestCase):
         self.assertFalse(self.db.has_test('foo.bar'))
         self.db.set_test_has_seen_test('foo.bar', '1')
         self.assertTrue(self.db.has_test('foo.bar'))
+
+    def test_record_tests(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        self.db.record_tests(revision_id, {
+            'foo.tests:FooTest.test_bar': {'foo/bar.py': {3: 0, 4: 1}},
+        }, {'foo.tests:FooTest.test_bar': set(['foo/bar.json'])})
+
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [4]), ['foo.tests:FooTest.test_bar'])
+        self.assertEquals(self.db.get_dependents(revision_id, 'foo/bar.json'), ['foo.tests:FooTest.test_bar'])
+
+    def test_function_coverage(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        test_id = self.db.add_test(revision_id, 'foo.tests:FooTest.test_bar')
+        self.db.add_function_coverage(revision_id, test_id, 'foo/bar.py', {
+            (10, 20, 'bar'): 1,
+        })
+
+        self.assertTrue(self.db.has_coverage(revision_id, 'foo/bar.py'))
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [15]), ['foo.tests:FooTest.test_bar'])
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [8, 9, 10]), ['foo.tests:FooTest.test_bar'])
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [5, 21, 22]), [])
+
+    def test_functions_on_same_line(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        self.db.record_tests(revision_id, {
+            'foo.tests:FooTest.test_bar': {'foo/bar.py': {(2, 2, '<lambda>'): 1, (2, 2, '<genexpr>'): 2}},
+        }, functions=True)
+
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [2]), ['foo.tests:FooTest.test_bar'])
+
+    def test_selections(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        self.assertEquals(self.db.get_selection(revision_id, 'b' * 40), None)
+
+        self.db.add_selection(revision_id, 'b' * 40, '{}')
+        self.assertEquals(self.db.get_selection(revision_id, 'b' * 40), '{}')
+
+        self.db.add_revision('c' * 40, datetime.datetime(2012, 1, 2))
+        self.assertEquals(self.db.trim_revisions(1), 1)
+        self.assertEquals(self.db.get_revisions(), set(['c' * 40]))
+        self.assertEquals(self.db.get_selection(revision_id, 'b' * 40), None)
+
+    def test_revision_version(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        self.assertEquals(self.db.get_revision_version(revision_id), None)
+
+        test_data = {'foo.tests:FooTest.test_bar': {'foo/bar.py': {3: 0}}}
+        self.db.record_tests(revision_id, test_data)
+        version = self.db.get_revision_version(revision_id)
+        self.assertNotEquals(version, None)
+
+        self.db.record_tests(revision_id, test_data)
+        self.assertNotEquals(self.db.get_revision_version(revision_id), version)
+
+    def test_dependencies(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        test_id = self.db.add_test(revision_id, 'foo.tests:FooTest.test_bar')
+        self.db.add_dependencies(revision_id, test_id, ['foo/fixtures/bar.json'])
+
+        self.assertEquals(self.db.get_dependents(revision_id, 'foo/fixtures/bar.json'), ['foo.tests:FooTest.test_bar'])
+        self.assertEquals(self.db.get_dependents(revision_id, 'foo/fixtures/baz.json'), [])
+
+        self.db.remove_test(revision_id, 'foo.tests:FooTest.test_bar')
+        self.assertEquals(self.db.get_dependents(revision_id, 'foo/fixtures/bar.json'), [])
+
+
+@skipUnless(os.environ.get('KLEENEX_TEST_POSTGRES'), 'KLEENEX_TEST_POSTGRES is not set')
+class PostgresCoverageDBTest(TestCase):
+    """
+    Runs against the database in ``KLEENEX_TEST_POSTGRES``, for example:
+
+        KLEENEX_TEST_POSTGRES=postgresql://postgres@localhost/kleenex_test
+    """
+    def setUp(self):
+        self.db = CoverageDB(os.environ['KLEENEX_TEST_POSTGRES'], logger=logging.getLogger(__name__))
+        metadata.drop_all(self.db.conn)
+        self.db.upgrade()
+
+    def tearDown(self):
+        metadata.drop_all(self.db.conn)
+
+    def test_record_tests(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        test_data = {
+            'foo.tests:FooTest.test_bar': {'foo/bar.py': {3: 0, 4: 1}},
+            'foo.tests:FooTest.test_baz': {'foo/bar.py': {4: 0}, 'foo/tab\tname.py': {1: 2}},
+        }
+
+        trans = self.db.begin()
+        self.db.record_tests(revision_id, test_data, {'foo.tests:FooTest.test_bar': set(['foo/bar.json'])})
+        trans.commit()
+
+        self.assertEquals(sorted(self.db.get_coverage(revision_id, 'foo/bar.py', [4])),
+                          ['foo.tests:FooTest.test_bar', 'foo.tests:FooTest.test_baz'])
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/tab\tname.py', [1]), ['foo.tests:FooTest.test_baz'])
+        self.assertEquals(self.db.get_dependents(revision_id, 'foo/bar.json'), ['foo.tests:FooTest.test_bar'])
+
+        # recording again replaces the existing data
+        trans = self.db.begin()
+        self.db.record_tests(revision_id, {'foo.tests:FooTest.test_bar': {'foo/bar.py': {5: 0}}})
+        trans.commit()
+
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [4]), ['foo.tests:FooTest.test_baz'])
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [5]), ['foo.tests:FooTest.test_bar'])
+        self.assertEquals(self.db.get_dependents(revision_id, 'foo/bar.json'), [])
+
+    def test_record_functions(self):
+        revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+
+        trans = self.db.begin()
+        self.db.record_tests(revision_id, {
+            'foo.tests:FooTest.test_bar': {'foo/bar.py': {
+                (10, 20, 'bar'): 1,
+                (12, 12, '<lambda>'): 2,
+                (12, 12, '<genexpr>'): 3,
+            }},
+        }, functions=True)
+        trans.commit()
+
+        self.assertEquals(self.db.get_coverage(revision_id, 'foo/bar.py', [15]), ['foo.tests:FooTest.test_bar'])
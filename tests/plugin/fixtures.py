@@ -0,0 +1,56 @@
+from functools import wraps
+from unittest2 import TestCase
+
+
+def helper(value):
+    return value
+
+
+def check_value(value):
+    if value == 0:
+        return 0
+    return helper(value)
+
+
+def decorated(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def test_function():
+    pass
+
+
+def test_generator():
+    for value in (1, 0):
+        yield check_value, value
+
+
+class PlainTests(object):
+    def test_method(self):
+        pass
+
+    def test_generator(self):
+        for value in (1, 0):
+            yield self.check_value, value
+
+    def test_inline_generator(self):
+        for value in (1, 0):
+            yield check_value, value
+
+    def check_value(self, value):
+        return check_value(value)
+
+
+class CaseTests(TestCase):
+    def test_method(self):
+        pass
+
+
+class DecoratedTests(TestCase):
+    @decorated
+    @decorated
+    def test_method(self):
+        helper(1)
@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+
+from unittest2 import TestCase
+
+from nose.case import FunctionTestCase, MethodTestCase, Test
+from nose.config import Config
+from optparse import OptionParser
+
+from kleenex.plugin import TestCoveragePlugin
+from tests.plugin import fixtures
+
+import inspect
+import os
+import tempfile
+
+
+class PluginTestBase(TestCase):
+    def make_plugin(self, **options):
+        fd, filename = tempfile.mkstemp(suffix='.cfg')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('[kleenex]\n')
+            for key, value in options.iteritems():
+                fp.write('%s = %s\n' % (key, value))
+        self.addCleanup(os.unlink, filename)
+
+        plugin = TestCoveragePlugin()
+        parser = OptionParser()
+        plugin.addOptions(parser, {})
+        plugin.configure(parser.parse_args(['--with-kleenex', '--kleenex-config=%s' % filename])[0], Config())
+        return plugin
+
+
+class TestNameTest(PluginTestBase):
+    "The name a test is recorded under must be the one it's selected by."
+    def setUp(self):
+        self.plugin = self.make_plugin(discover='true', record='false', report='false', test_missing='false')
+
+    def assertSelects(self, case, want, obj):
+        self.plugin.pending_funcs = set()
+        self.assertFalse(want(obj))
+
+        self.plugin.pending_funcs = set([self.plugin._get_name_from_test(case)])
+        self.assertTrue(want(obj))
+
+    def test_function(self):
+        case = FunctionTestCase(fixtures.test_function)
+        self.assertSelects(case, self.plugin.wantFunction, fixtures.test_function)
+
+    def test_generator_function(self):
+        case = FunctionTestCase(fixtures.check_value, arg=(1,), descriptor=fixtures.test_generator)
+        self.assertSelects(case, self.plugin.wantFunction, fixtures.test_generator)
+
+    def test_method(self):
+        case = MethodTestCase(fixtures.PlainTests.test_method)
+        self.assertSelects(case, self.plugin.wantMethod, fixtures.PlainTests.test_method)
+
+    def test_generator_method(self):
+        generator = fixtures.PlainTests().test_generator
+        case = MethodTestCase(fixtures.PlainTests().check_value, arg=(1,), descriptor=generator)
+        self.assertSelects(case, self.plugin.wantMethod, fixtures.PlainTests.test_generator)
+
+    def test_inline_generator_method(self):
+        generator = fixtures.PlainTests().test_inline_generator
+        case = MethodTestCase(generator, test=fixtures.check_value, arg=(1,))
+        self.assertSelects(case, self.plugin.wantMethod, fixtures.PlainTests.test_inline_generator)
+
+    def test_unittest_method(self):
+        case = fixtures.CaseTests('test_method')
+        self.assertSelects(case, self.plugin.wantMethod, fixtures.CaseTests.test_method)
+
+
+class GeneratorRecordTest(PluginTestBase):
+    "Every test yielded by a generator contributes to its recorded coverage."
+    test_name = 'tests.plugin.fixtures:test_generator'
+    filename = 'tests/plugin/fixtures.py'
+
+    def record(self, granularity, max_distance=4):
+        plugin = self.make_plugin(record='true', report='false', granularity=granularity,
+                                  max_distance=max_distance)
+        plugin.coverage = plugin._setup_coverage()
+        plugin.file_tracker = None
+
+        for test_func, arg in fixtures.test_generator():
+            test = Test(FunctionTestCase(test_func, arg=(arg,), descriptor=fixtures.test_generator))
+            plugin.startTest(test)
+            test.test.runTest()
+            plugin.stopTest(test)
+
+        return plugin.test_data[self.test_name][self.filename]
+
+    def test_lines(self):
+        data = self.record('line')
+        lines, lineno = inspect.getsourcelines(fixtures.check_value)
+
+        # the first instance returns through helper, the second returns early
+        self.assertEquals(data[lineno + 2], 0)
+        self.assertEquals(data[lineno + 3], 0)
+        self.assertEquals(data[inspect.getsourcelines(fixtures.helper)[1] + 1], 1)
+
+    def test_functions(self):
+        data = self.record('function')
+        distances = dict((name, distance) for (lineno, end_lineno, name), distance in data.iteritems())
+
+        self.assertEquals(distances['check_value'], 0)
+        self.assertEquals(distances['helper'], 1)
+
+    def test_max_distance_is_inclusive(self):
+        names = lambda data: set(name for lineno, end_lineno, name in data)
+
+        self.assertEquals(names(self.record('function', max_distance=1)), set(['check_value', 'helper']))
+        self.assertEquals(names(self.record('function', max_distance=0)), set(['check_value']))
+
+
+class ReportOnlyTest(PluginTestBase):
+    def test_does_not_connect(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, path)
+
+        # the database's directory doesn't exist, so connecting would fail
+        plugin = self.make_plugin(record='false', report='true', parent='HEAD',
+                                  db='sqlite:///%s' % os.path.join(path, 'missing', 'coverage.db'))
+        plugin.begin()
+
+        self.assertEquals(plugin.db, None)
+        self.assertEquals(plugin.selection_cache, None)
+
+
+class DecoratedRecordTest(PluginTestBase):
+    "Decorators around a test don't change the distance of what it calls."
+    def test_lines(self):
+        plugin = self.make_plugin(record='true', report='false', max_distance=1)
+        plugin.coverage = plugin._setup_coverage()
+        plugin.file_tracker = None
+
+        case = fixtures.DecoratedTests('test_method')
+        test = Test(case)
+        plugin.startTest(test)
+        case.test_method()
+        plugin.stopTest(test)
+
+        data = plugin.test_data['tests.plugin.fixtures:DecoratedTests.test_method']['tests/plugin/fixtures.py']
+        lines, lineno = inspect.getsourcelines(fixtures.DecoratedTests)
+        wrapper_lineno = inspect.getsourcelines(fixtures.decorated)[1] + 3
+
+        self.assertEquals(data[lineno + lines.index('        helper(1)\n')], 0)
+        self.assertEquals(data[inspect.getsourcelines(fixtures.helper)[1] + 1], 1)
+        self.assertFalse(wrapper_lineno in data)
@@ -0,0 +1,81 @@
+from unittest2 import TestCase
+
+from kleenex.db import CoverageDB
+from kleenex.server import CoverageClient, CoverageIndex, CoverageServer
+
+import datetime
+import logging
+import os
+import os.path
+import tempfile
+import threading
+
+
+class CoverageIndexTest(TestCase):
+    def setUp(self):
+        self.db = CoverageDB('sqlite:///test.db', logger=logging.getLogger(__name__))
+        self.db.upgrade()
+
+        self.revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        test_id = self.db.add_test(self.revision_id, 'foo.tests:FooTest.test_bar')
+        self.db.add_coverage(self.revision_id, test_id, 'foo/bar.py', {3: 0, 4: 1})
+        test_id = self.db.add_test(self.revision_id, 'foo.tests:FooTest.test_baz')
+        self.db.add_function_coverage(self.revision_id, test_id, 'foo/baz.py', {(10, 20, 'baz'): 1})
+
+    def tearDown(self):
+        os.unlink('test.db')
+
+    def test_get_coverage(self):
+        index = CoverageIndex(self.db, self.revision_id)
+
+        self.assertEquals(index.get_coverage('foo/bar.py', [4, 5]), ['foo.tests:FooTest.test_bar'])
+        self.assertEquals(index.get_coverage('foo/bar.py', [5]), [])
+        self.assertEquals(index.get_coverage('foo/baz.py', [20, 21]), ['foo.tests:FooTest.test_baz'])
+        self.assertTrue(index.has_coverage('foo/baz.py'))
+        self.assertFalse(index.has_coverage('foo/missing.py'))
+        self.assertTrue(index.has_test('foo.tests:FooTest.test_bar'))
+
+
+class CoverageServerTest(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger(__name__)
+        self.db = CoverageDB('sqlite:///test.db', logger=self.logger)
+        self.db.upgrade()
+        self.revision_id = self.db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        self.db.record_tests(self.revision_id, {'foo.tests:FooTest.test_bar': {'foo/bar.py': {3: 0}}})
+
+        self.path = os.path.join(tempfile.mkdtemp(), 'kleenex.sock')
+        self.server = CoverageServer(self.path, 'sqlite:///test.db', self.logger)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = CoverageClient(self.path, self.logger)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.db.close()
+        os.rmdir(os.path.dirname(self.path))
+        os.unlink('test.db')
+
+    def test_round_trip(self):
+        revision_id = self.client.get_revision_id('a' * 40)
+        self.assertEquals(revision_id, self.revision_id)
+        self.assertEquals(self.client.get_revisions(), set(['a' * 40]))
+        self.assertEquals(self.client.get_coverage(revision_id, 'foo/bar.py', [3]), ['foo.tests:FooTest.test_bar'])
+        self.assertTrue(self.client.has_coverage(revision_id, 'foo/bar.py'))
+        self.assertTrue(self.client.has_test(revision_id, 'foo.tests:FooTest.test_bar'))
+        self.assertEquals(self.client.get_dependents(revision_id, 'foo/bar.json'), [])
+
+    def test_unknown_revision(self):
+        self.assertRaises(ValueError, self.client.get_revision_id, 'b' * 40)
+        # the connection is still usable afterwards
+        self.assertEquals(self.client.get_revision_id('a' * 40), self.revision_id)
+
+    def test_reloads_rerecorded_revision(self):
+        self.server.check_interval = 0
+        self.assertEquals(self.client.get_coverage(self.revision_id, 'foo/baz.py', [5]), [])
+
+        self.db.record_tests(self.revision_id, {'foo.tests:FooTest.test_baz': {'foo/baz.py': {5: 0}}})
+        self.assertEquals(self.client.get_coverage(self.revision_id, 'foo/baz.py', [5]), ['foo.tests:FooTest.test_baz'])
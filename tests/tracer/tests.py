@@ -0,0 +1,140 @@
+from unittest2 import TestCase
+
+from kleenex.db import CoverageDB
+from kleenex.tracer import ExtendedTracer, FileTracker, FunctionTracer, NO_DISTANCE
+
+import datetime
+import logging
+import os
+import os.path
+
+
+def helper():
+    return 1
+
+
+def entry():
+    return helper()
+
+
+def runner():
+    return entry()
+
+
+def decorated(func):
+    def wrapper():
+        return func()
+    return wrapper
+
+
+def decorated_entry():
+    return helper()
+
+
+def decorated_runner():
+    return decorated(decorated_entry)()
+
+
+def sort_sums(xs):
+    return sorted(xs, key=lambda x: sum(y for y in x))
+
+
+class FileTrackerTest(TestCase):
+    def setUp(self):
+        self.root = os.path.dirname(__file__)
+        self.filename = os.path.join(self.root, 'data.txt')
+        with open(self.filename, 'w') as fp:
+            fp.write('foo')
+        self.tracker = FileTracker(self.root)
+
+    def tearDown(self):
+        self.tracker.stop()
+        os.unlink(self.filename)
+
+    def test_records_project_files(self):
+        self.tracker.start()
+        open(self.filename).close()
+        open(os.path.join(self.root, '__init__.py')).close()
+        open(os.devnull).close()
+        self.tracker.stop()
+
+        self.assertEquals(self.tracker.files, set(['data.txt']))
+
+    def test_ignores_writes(self):
+        self.tracker.start()
+        open(self.filename, 'w').close()
+        self.tracker.stop()
+
+        self.assertEquals(self.tracker.files, set())
+
+
+class EntryTracerTest(TestCase):
+    def _trace(self, tracer_class):
+        tracer = tracer_class()
+        tracer.data = {}
+        tracer.should_trace = lambda filename, frame: filename
+        tracer.should_trace_cache = {}
+        tracer.entry_codes = frozenset([entry.func_code])
+        tracer.start()
+        try:
+            runner()
+        finally:
+            tracer.stop()
+        return tracer.data[helper.func_code.co_filename]
+
+    def test_line_distance(self):
+        data = self._trace(ExtendedTracer)
+
+        self.assertEquals(data[runner.func_code.co_firstlineno + 1], NO_DISTANCE)
+        self.assertEquals(data[entry.func_code.co_firstlineno + 1], 0)
+        self.assertEquals(data[helper.func_code.co_firstlineno + 1], 1)
+
+    def test_decorated_entry(self):
+        tracer = ExtendedTracer()
+        tracer.data = {}
+        tracer.should_trace = lambda filename, frame: filename
+        tracer.should_trace_cache = {}
+        # the decorator's wrapper isn't the entry, so it's matched by name
+        tracer.entry_names = frozenset(['decorated_entry'])
+        tracer.start()
+        try:
+            decorated_runner()
+        finally:
+            tracer.stop()
+        data = tracer.data[helper.func_code.co_filename]
+
+        self.assertEquals(data[decorated.func_code.co_firstlineno + 2], NO_DISTANCE)
+        self.assertEquals(data[decorated_entry.func_code.co_firstlineno + 1], 0)
+        self.assertEquals(data[helper.func_code.co_firstlineno + 1], 1)
+
+    def test_function_distance(self):
+        data = self._trace(FunctionTracer)
+        distances = dict((name, distance) for (lineno, end_lineno, name), distance in data.iteritems())
+
+        self.assertEquals(distances, {'runner': NO_DISTANCE, 'entry': 0, 'helper': 1})
+
+    def test_functions_on_same_line(self):
+        tracer = FunctionTracer()
+        tracer.data = {}
+        tracer.should_trace = lambda filename, frame: filename
+        tracer.should_trace_cache = {}
+        tracer.entry_codes = frozenset([sort_sums.func_code])
+        tracer.start()
+        try:
+            sort_sums([[2], [1]])
+        finally:
+            tracer.stop()
+
+        lineno = sort_sums.func_code.co_firstlineno + 1
+        data = tracer.data[sort_sums.func_code.co_filename]
+        self.assertEquals(data[(lineno, lineno, '<lambda>')], 1)
+        self.assertEquals(data[(lineno, lineno, '<genexpr>')], 2)
+
+        db = CoverageDB('sqlite:///test.db', logging.getLogger(__name__))
+        self.addCleanup(os.unlink, 'test.db')
+        db.upgrade()
+        revision_id = db.add_revision('a' * 40, datetime.datetime(2012, 1, 1))
+        db.record_tests(revision_id, {'tests.tracer.tests:sort_sums': {'tests/tracer/tests.py': data}},
+                        functions=True)
+        self.assertEquals(db.get_coverage(revision_id, 'tests/tracer/tests.py', [lineno]),
+                          ['tests.tracer.tests:sort_sums'])